@@ -0,0 +1,262 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from typing import List, Dict, Optional, Tuple
+
+import aiosqlite
+import orjson
+from cachetools import LRUCache
+
+# Имя файла, в котором будет храниться вся наша база данных
+DB_FILE = "conversation_history.db"
+
+# Стандартный лимит истории, если пользователь не задал свой
+DEFAULT_HISTORY_LIMIT = 12
+
+# Сколько последних сообщений каждого пользователя хранить в базе.
+# Берем с запасом относительно максимального лимита из меню настроек (20),
+# а все более старое удаляется при добавлении новых сообщений — таблица и индекс не растут бесконечно.
+HISTORY_RETENTION = 40
+
+# Единственное долгоживущее подключение к базе, создается в init_db() и закрывается в close_db().
+# Открывать новое подключение на каждый запрос дорого (открытие файла, чтение схемы,
+# потеря кэша подготовленных запросов), поэтому все функции модуля используют это.
+# aiosqlite выполняет запросы в отдельном потоке, так что они не блокируют цикл событий бота.
+# isolation_level=None — режим автокоммита: каждая одиночная команда сама является транзакцией.
+_conn: Optional[aiosqlite.Connection] = None
+
+# Колонки таблицы history. Обычное текстовое сообщение хранится в text,
+# а parts (JSON) заполняется, только если сообщение не сводится к одному тексту.
+HISTORY_COLUMNS = """
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT,
+    parts BLOB,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+"""
+
+# SQL-запросы горячего пути вынесены в константы: sqlite3 кэширует подготовленные
+# запросы по тексту SQL, а константы гарантируют, что текст при каждом вызове один и тот же.
+SQL_SET_LIMIT = "INSERT OR REPLACE INTO user_settings (user_id, history_limit) VALUES (?, ?)"
+SQL_SELECT_LIMIT = "SELECT history_limit FROM user_settings WHERE user_id = ?"
+SQL_INSERT_HISTORY = "INSERT INTO history (user_id, role, text, parts) VALUES (?, ?, ?, ?)"
+# Лимит истории подставляется подзапросом, чтобы получить историю за одно обращение к базе.
+# Внутренний запрос берет N последних сообщений, внешний сразу возвращает их
+# в хронологическом порядке (от старых к новым), как того требует Gemini.
+SQL_SELECT_HISTORY = f"""
+    SELECT role, text, parts FROM (
+        SELECT id, role, text, parts FROM history WHERE user_id = ? ORDER BY id DESC
+        LIMIT COALESCE((SELECT history_limit FROM user_settings WHERE user_id = ?), {DEFAULT_HISTORY_LIMIT})
+    ) ORDER BY id
+"""
+SQL_DELETE_HISTORY = "DELETE FROM history WHERE user_id = ?"
+# Удаляет все сообщения пользователя старше HISTORY_RETENTION последних.
+# Если сообщений меньше, подзапрос вернет NULL и ничего не удалится.
+SQL_PRUNE_HISTORY = """
+    DELETE FROM history WHERE user_id = ? AND id < (
+        SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+    )
+"""
+
+# Подключение общее для всех обработчиков, поэтому запись выполняем под блокировкой:
+# так команды разных задач не попадут в чужую транзакцию, а писатели не будут
+# конкурировать друг с другом за блокировку файла базы.
+_lock = asyncio.Lock()
+
+# Кэш лимитов истории в памяти: настройка меняется редко (только через меню настроек),
+# поэтому не обращаемся за ней к базе каждый раз. Обновляется в set_history_limit.
+# Размер ограничен: давно неактивные пользователи вытесняются и при необходимости читаются из базы заново.
+_limit_cache: LRUCache = LRUCache(maxsize=10_000)
+
+
+async def init_db():
+    """
+    Инициализирует базу данных.
+    Открывает общее подключение и создает две таблицы: `history` для сообщений и `user_settings` для настроек.
+    Вызывается один раз при старте бота.
+    """
+    global _conn
+    _conn = await aiosqlite.connect(DB_FILE, isolation_level=None)
+
+    # Включаем режим WAL: читатели и писатели больше не блокируют друг друга,
+    # а каждый коммит обходится одним fsync вместо двух.
+    # Режим сохраняется в самом файле базы, а не в подключении.
+    # Важно: рядом с базой теперь живут файлы conversation_history.db-wal и -shm,
+    # они являются частью базы — копировать и удалять их нужно только вместе с ней.
+    await _conn.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL уровень NORMAL безопасен и заметно быстрее FULL.
+    await _conn.execute("PRAGMA synchronous=NORMAL")
+    await _conn.execute("PRAGMA temp_store=MEMORY")
+    await _conn.execute("PRAGMA mmap_size=268435456")  # 256 МБ
+    await _conn.execute("PRAGMA cache_size=-20000")  # ~20 МБ
+
+    # 1. Таблица для хранения истории диалогов
+    await _conn.execute(f"CREATE TABLE IF NOT EXISTS history ({HISTORY_COLUMNS})")
+
+    # В базах, созданных до появления колонки text, добавляем ее
+    async with _conn.execute("PRAGMA table_info(history)") as cursor:
+        columns = [row[1] async for row in cursor]
+    if "text" not in columns:
+        await _migrate_history_add_text()
+
+    # Индекс под выборку последних сообщений пользователя в get_history:
+    # вместо полного просмотра таблицы и сортировки читаются только нужные N строк.
+    # Сортируем по id, а не по timestamp: id растет в порядке вставки и не дает "ничьих"
+    # у сообщений, сохраненных в одну и ту же секунду.
+    # Он же ускоряет DELETE по user_id в clear_history, так как user_id — первая колонка индекса.
+    await _conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id_desc ON history (user_id, id DESC)")
+    # Прежний индекс по timestamp больше не используется
+    await _conn.execute("DROP INDEX IF EXISTS idx_history_user_ts")
+
+    # 2. Таблица для хранения персональных настроек пользователей
+    await _conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id INTEGER PRIMARY KEY,
+            history_limit INTEGER NOT NULL DEFAULT {}
+        )
+    """.format(DEFAULT_HISTORY_LIMIT))
+
+
+async def _migrate_history_add_text():
+    """
+    Переносит таблицу history на схему с колонкой text.
+    В старой схеме parts объявлена как NOT NULL, а ALTER TABLE в SQLite не умеет снимать
+    это ограничение, поэтому таблица пересоздается, а все сообщения копируются как есть
+    (text для них остается NULL, и они по-прежнему читаются из parts).
+    """
+    async with _write_transaction() as conn:
+        await conn.execute(f"CREATE TABLE history_new ({HISTORY_COLUMNS})")
+        await conn.execute("""
+            INSERT INTO history_new (id, user_id, role, parts, timestamp)
+            SELECT id, user_id, role, parts, timestamp FROM history
+        """)
+        await conn.execute("DROP TABLE history")
+        await conn.execute("ALTER TABLE history_new RENAME TO history")
+
+
+async def close_db():
+    """
+    Закрывает общее подключение к базе данных.
+    Вызывается один раз при остановке бота.
+    """
+    global _conn
+    if _conn is not None:
+        await _conn.close()
+        _conn = None
+
+
+def _encode_parts(parts: List[Dict]) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Готовит 'parts' к записи в базу, возвращая пару (text, parts).
+    Почти все сообщения имеют вид [{"text": "..."}] — для них храним только сам текст
+    в колонке text, без сериализации в JSON.
+    Остальные варианты в базе можно хранить только как простые типы, поэтому
+    преобразуем список в JSON (orjson сразу отдает bytes, которые хранятся как BLOB).
+    """
+    if len(parts) == 1 and parts[0].keys() == {"text"} and isinstance(parts[0]["text"], str):
+        return parts[0]["text"], None
+    return None, orjson.dumps(parts)
+
+
+def _decode_parts(text: Optional[str], parts_json: Optional[bytes]) -> List[Dict]:
+    """
+    Восстанавливает 'parts' из строки базы — обратная операция к _encode_parts.
+    orjson.loads читает и bytes, и строки, так что старые TEXT-записи тоже подходят.
+    """
+    if text is not None:
+        return [{"text": text}]
+    return orjson.loads(parts_json)
+
+
+@asynccontextmanager
+async def _write_transaction():
+    """
+    Открывает транзакцию записи под общей блокировкой.
+    BEGIN IMMEDIATE сразу берет блокировку записи в базе, а не повышает ее по ходу транзакции,
+    поэтому писатели не получают SQLITE_BUSY посреди уже начатой работы.
+    Подключение работает в режиме автокоммита, так что Python не вставляет свой BEGIN.
+    """
+    async with _lock:
+        try:
+            await _conn.execute("BEGIN IMMEDIATE")
+            yield _conn
+            await _conn.execute("COMMIT")
+        except BaseException:
+            # Откатываем при любой ошибке, включая сбой самого COMMIT и отмену задачи
+            # во время BEGIN, иначе общее подключение так и останется внутри открытой
+            # транзакции и все следующие BEGIN будут падать.
+            # При отмене BEGIN уже стоит в очереди потока aiosqlite и выполнится позже,
+            # поэтому in_transaction здесь проверять нельзя: ROLLBACK встанет в ту же очередь
+            # следом за ним. Если транзакции к этому моменту нет, SQLite вернет ошибку — ее глушим.
+            with suppress(aiosqlite.OperationalError):
+                await _conn.execute("ROLLBACK")
+            raise
+
+
+async def set_history_limit(user_id: int, limit: int):
+    """
+    Устанавливает или обновляет лимит истории для конкретного пользователя.
+    """
+    async with _write_transaction() as conn:
+        # Команда INSERT OR REPLACE очень удобна:
+        # она создает запись, если ее нет, или заменяет существующую.
+        await conn.execute(SQL_SET_LIMIT, (user_id, limit))
+    _limit_cache[user_id] = limit
+
+
+async def get_history_limit(user_id: int) -> int:
+    """
+    Получает лимит истории для пользователя.
+    Если для пользователя настройка не найдена, возвращает значение по умолчанию.
+    """
+    limit = _limit_cache.get(user_id)
+    if limit is not None:
+        return limit
+
+    async with _conn.execute(SQL_SELECT_LIMIT, (user_id,)) as cursor:
+        result = await cursor.fetchone()
+    # Если result не пустой (т.е. запись найдена), возвращаем значение. Иначе - стандартное.
+    limit = result[0] if result else DEFAULT_HISTORY_LIMIT
+    # setdefault не затрет значение, если set_history_limit успел записать новое, пока шел запрос
+    return _limit_cache.setdefault(user_id, limit)
+
+
+async def add_message_to_history(user_id: int, role: str, parts: List[Dict]):
+    """
+    Добавляет одно сообщение (пользователя или модели) в таблицу history.
+    """
+    return await add_messages_to_history(user_id, [(role, parts)])
+
+
+async def add_messages_to_history(user_id: int, turns: List[Tuple[str, List[Dict]]]):
+    """
+    Добавляет несколько сообщений (например, вопрос пользователя и ответ модели)
+    в таблицу history одной транзакцией — один коммит вместо отдельного на каждое сообщение.
+    В той же транзакции удаляет сообщения, вышедшие за пределы HISTORY_RETENTION.
+    """
+    rows = [(user_id, role, *_encode_parts(parts)) for role, parts in turns]
+    async with _write_transaction() as conn:
+        await conn.executemany(SQL_INSERT_HISTORY, rows)
+        await conn.execute(SQL_PRUNE_HISTORY, (user_id, user_id, HISTORY_RETENTION - 1))
+
+
+async def get_history(user_id: int) -> List[Dict]:
+    """
+    Извлекает историю сообщений для пользователя, используя его персональный лимит.
+    Форматирует данные в список, готовый для отправки в Gemini API.
+    """
+    # Выбираем N последних сообщений для данного пользователя,
+    # где N — его персональный лимит (или стандартный, если он не задан)
+    # Строки приходят уже в нужном порядке, поэтому разбираем их прямо по ходу чтения курсора,
+    # преобразуя обратно в формат, который понимает Gemini API.
+    async with _conn.execute(SQL_SELECT_HISTORY, (user_id, user_id)) as cursor:
+        return [{"role": role, "parts": _decode_parts(text, parts_json)} async for role, text, parts_json in cursor]
+
+
+async def clear_history(user_id: int):
+    """
+    Полностью удаляет историю диалога для указанного пользователя.
+    Не затрагивает его настройки.
+    """
+    async with _write_transaction() as conn:
+        await conn.execute(SQL_DELETE_HISTORY, (user_id,))